@@ -67,6 +67,13 @@ def additional_tests(ykman_cli):
             creds = ykman_cli('oath', 'code', '-H')
             self.assertIn('_hidden:name', creds)
 
+        def test_oath_hidden_cred_exact_match(self):
+            ykman_cli('oath', 'add', '_hidden:name', 'abba')
+            creds = ykman_cli('oath', 'code', '_hidden:name')
+            self.assertIn('_hidden:name', creds)
+            creds = ykman_cli('oath', 'code', 'name')
+            self.assertNotIn('_hidden:name', creds)
+
         def test_oath_add_uri_hotp(self):
             ykman_cli('oath', 'uri', URI_HOTP_EXAMPLE)
             creds = ykman_cli('oath', 'list')
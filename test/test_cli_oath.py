@@ -0,0 +1,215 @@
+import hashlib
+import shutil
+import tempfile
+import unittest
+
+try:
+    from unittest.mock import Mock, patch
+except ImportError:
+    from mock import Mock, patch
+
+from click.testing import CliRunner
+from ykman.cli.oath import oath
+from ykman.cli.util import YkmanContextObject
+from ykman.oath import Code, Credential, OATH_TYPE
+from ykman.settings import Settings
+
+
+DEVICE_ID = 'DEVID'
+PASSWORD = 'correct'
+
+
+def _derive_key(password):
+    return hashlib.sha256(password.encode('utf-8')).digest()[:16]
+
+
+def _validate(key):
+    if key != _derive_key(PASSWORD):
+        raise ValueError('Wrong key')
+
+
+def make_controller():
+    controller = Mock()
+    controller.id = DEVICE_ID
+    controller.locked = True
+    controller.version = (5, 2, 4)
+    controller.derive_key.side_effect = _derive_key
+    controller.validate.side_effect = _validate
+    controller.set_password.side_effect = _derive_key
+    controller.list.return_value = []
+    return controller
+
+
+class CliTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.conf_dir = tempfile.mkdtemp()
+        patcher = patch('ykman.settings._get_conf_dir',
+                        return_value=self.conf_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.conf_dir)
+
+    def invoke(self, *args, **kwargs):
+        controller = kwargs.get('controller') or make_controller()
+        obj = YkmanContextObject()
+        obj.add_resolver('dev', Mock)
+        with patch('ykman.cli.oath.OathController', return_value=controller):
+            result = CliRunner().invoke(oath, args, obj=obj)
+        return result, controller
+
+
+class TestCacheDerived(CliTestCase):
+
+    def derived(self):
+        return Settings('oath').get('derived', {})
+
+    def test_cache_hit_skips_derive_key(self):
+        result, controller = self.invoke(
+            '-p', PASSWORD, '--cache-derived', 'list')
+        self.assertEqual(0, result.exit_code)
+        controller.derive_key.assert_called_once_with(PASSWORD)
+        self.assertIn(DEVICE_ID, self.derived())
+
+        result, controller = self.invoke(
+            '-p', PASSWORD, '--cache-derived', 'list')
+        self.assertEqual(0, result.exit_code)
+        controller.derive_key.assert_not_called()
+        controller.validate.assert_called_once_with(_derive_key(PASSWORD))
+
+    def test_other_password_misses_cache(self):
+        self.invoke('-p', PASSWORD, '--cache-derived', 'list')
+
+        result, controller = self.invoke(
+            '-p', 'other', '--cache-derived', 'list')
+        self.assertNotEqual(0, result.exit_code)
+        controller.derive_key.assert_called_once_with('other')
+
+    def test_wrong_password_not_stored(self):
+        result, _ = self.invoke('-p', 'wrong', '--cache-derived', 'list')
+        self.assertNotEqual(0, result.exit_code)
+        self.assertNotIn(DEVICE_ID, self.derived())
+
+    def test_wrong_password_keeps_cached_entry(self):
+        self.invoke('-p', PASSWORD, '--cache-derived', 'list')
+        entry = self.derived()[DEVICE_ID]
+
+        self.invoke('-p', 'wrong', '--cache-derived', 'list')
+        self.assertEqual(entry, self.derived()[DEVICE_ID])
+
+    def test_unlocked_key_not_stored(self):
+        controller = make_controller()
+        controller.locked = False
+        result, _ = self.invoke(
+            '-p', 'whatever', '--cache-derived', 'info', controller=controller)
+        self.assertEqual(0, result.exit_code)
+        controller.derive_key.assert_not_called()
+        self.assertNotIn(DEVICE_ID, self.derived())
+
+    def test_set_password_without_flag_drops_entry(self):
+        self.invoke('-p', PASSWORD, '--cache-derived', 'list')
+        self.assertIn(DEVICE_ID, self.derived())
+
+        result, _ = self.invoke('-p', PASSWORD, 'set-password', '-n', 'new')
+        self.assertEqual(0, result.exit_code)
+        self.assertNotIn(DEVICE_ID, self.derived())
+
+    def test_forget_drops_entry(self):
+        self.invoke('-p', PASSWORD, '--cache-derived', 'list')
+        self.assertIn(DEVICE_ID, self.derived())
+
+        result, _ = self.invoke('remember-password', '--forget')
+        self.assertEqual(0, result.exit_code)
+        self.assertNotIn(DEVICE_ID, self.derived())
+
+
+def make_code_controller(version=(5, 2, 4)):
+    controller = make_controller()
+    controller.locked = False
+    controller.version = version
+    creds = [Credential(b'foo'), Credential(b'bar:abc'),
+             Credential(b'bar:abd'), Credential(b'hotp', OATH_TYPE.HOTP)]
+    controller.list.return_value = creds
+    controller.calculate_all.return_value = [
+        (cred, None if cred.oath_type == OATH_TYPE.HOTP else
+         Code(u'{:06d}'.format(i), 0, 30))
+        for i, cred in enumerate(creds)]
+    controller.calculate.return_value = Code(u'999999', 0, 30)
+    return controller
+
+
+class TestCode(CliTestCase):
+
+    def invoke_code(self, *args, **kwargs):
+        controller = make_code_controller(**kwargs)
+        return self.invoke('code', *args, controller=controller)
+
+    def test_single_hit(self):
+        result, controller = self.invoke_code('foo')
+        self.assertEqual(0, result.exit_code)
+        controller.list.assert_called_once_with()
+        controller.calculate_all.assert_not_called()
+        self.assertEqual(b'foo', controller.calculate.call_args[0][0].key)
+        self.assertEqual('foo  999999\n', result.output)
+
+    def test_single_option_with_several_hits(self):
+        result, controller = self.invoke_code('-s', 'bar')
+        self.assertEqual(1, result.exit_code)
+        controller.list.assert_called_once_with()
+        controller.calculate_all.assert_not_called()
+        controller.calculate.assert_not_called()
+        self.assertIn('Multiple matches', result.output)
+        self.assertIn('bar:abc', result.output)
+        self.assertIn('bar:abd', result.output)
+
+    def test_several_hits(self):
+        result, controller = self.invoke_code('bar')
+        self.assertEqual(0, result.exit_code)
+        controller.list.assert_called_once_with()
+        controller.calculate_all.assert_called_once_with()
+        controller.calculate.assert_not_called()
+        self.assertEqual('bar:abc  000001\nbar:abd  000002\n',
+                         result.output)
+
+    def test_hotp_hit(self):
+        result, controller = self.invoke_code('-s', 'hotp')
+        self.assertEqual(0, result.exit_code)
+        controller.calculate_all.assert_not_called()
+        self.assertEqual(b'hotp', controller.calculate.call_args[0][0].key)
+        self.assertEqual('999999\n', result.output)
+
+    def test_no_query(self):
+        result, controller = self.invoke_code()
+        self.assertEqual(0, result.exit_code)
+        controller.list.assert_not_called()
+        controller.calculate_all.assert_called_once_with()
+        controller.calculate.assert_not_called()
+        self.assertEqual(
+            'bar:abc             000001\n'
+            'bar:abd             000002\n'
+            'foo                 000000\n'
+            'hotp     [HOTP Credential]\n', result.output)
+
+    def test_426_firmware_uses_calculate_all(self):
+        result, controller = self.invoke_code('foo', version=(4, 2, 6))
+        self.assertEqual(0, result.exit_code)
+        controller.list.assert_not_called()
+        controller.calculate_all.assert_called_once_with()
+        controller.calculate.assert_not_called()
+        self.assertEqual('foo  000000\n', result.output)
+
+    def test_hidden_exact_match(self):
+        controller = make_code_controller()
+        hidden = Credential(b'_hidden:name')
+        controller.list.return_value = [hidden]
+        controller.calculate_all.return_value = [
+            (hidden, Code(u'123456', 0, 30))]
+
+        result, _ = self.invoke('code', '_hidden:name', controller=controller)
+        self.assertEqual('_hidden:name  999999\n', result.output)
+
+        result, _ = self.invoke('code', 'name', controller=controller)
+        self.assertEqual('', result.output)
+
+        result, _ = self.invoke('code', '-H', 'name', controller=controller)
+        self.assertEqual('_hidden:name  999999\n', result.output)
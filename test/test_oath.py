@@ -50,6 +50,20 @@ class TestOathFunctions(unittest.TestCase):
                          CredentialData(b'', None, 'name', period=20
                                         ).make_key())
 
+    def test_credential_printable_key(self):
+        cred = Credential(u'Issuer:nåme'.encode('utf-8'))
+        self.assertEqual(u'Issuer:nåme', cred.printable_key)
+        self.assertIs(cred.printable_key, cred.printable_key)
+
+    def test_credential_sort_key(self):
+        creds = [Credential(b'b'), Credential(b'Issuer:a'),
+                 Credential(b'issuer:B'), Credential(b'A')]
+        self.assertEqual(
+            [b'A', b'b', b'Issuer:a', b'issuer:B'],
+            [c.key for c in sorted(creds, key=lambda c: c.sort_key)])
+        self.assertEqual(sorted(creds, key=lambda c: c.sort_key),
+                         sorted(creds))
+
     def test_derive_key(self):
         self.assertEqual(
             b'\xb0}\xa1\xe7\xde\x87\xf8\x9a\x87\xa2\xb5\x98\xea\xa2\x18\x8c',
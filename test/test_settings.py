@@ -0,0 +1,120 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+from ykman.settings import Settings, _parse_keys
+
+
+class TestSettings(unittest.TestCase):
+
+    def setUp(self):
+        self.conf_dir = tempfile.mkdtemp()
+        patcher = patch('ykman.settings._get_conf_dir',
+                        return_value=self.conf_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.conf_dir)
+
+    def test_keys_round_trip(self):
+        settings = Settings('test')
+        settings['other'] = 'value'
+        settings.set_key('device1', b'\0\1\2\3')
+        settings.set_key('device2', b'0123456789abcdef')
+        settings.write()
+
+        settings = Settings('test')
+        self.assertEqual('value', settings['other'])
+        self.assertEqual(b'\0\1\2\3', settings.get_key('device1'))
+        self.assertEqual(b'0123456789abcdef', settings.get_key('device2'))
+        self.assertIsNone(settings.get_key('device3'))
+
+    def test_delete_key(self):
+        settings = Settings('test')
+        settings.set_key('device1', b'key')
+        self.assertTrue(settings.delete_key('device1'))
+        self.assertFalse(settings.delete_key('device1'))
+        self.assertIsNone(settings.get_key('device1'))
+
+    def test_clear_keys_removes_file(self):
+        settings = Settings('test')
+        settings.set_key('device1', b'key')
+        settings.write()
+        self.assertTrue(os.path.isfile(settings.keys_fname))
+
+        settings.clear_keys()
+        settings.write()
+        self.assertFalse(os.path.isfile(settings.keys_fname))
+
+    def test_dirty(self):
+        settings = Settings('test')
+        self.assertFalse(settings.dirty)
+        self.assertIsNone(settings.get_key('device1'))
+        self.assertFalse(settings.delete_key('device1'))
+        self.assertFalse(settings.dirty)
+
+        settings.set_key('device1', b'key')
+        self.assertTrue(settings.dirty)
+        settings.write()
+        self.assertFalse(settings.dirty)
+
+        self.assertTrue(settings.delete_key('device1'))
+        self.assertTrue(settings.dirty)
+        settings.write()
+
+        settings.clear_keys()
+        self.assertTrue(settings.dirty)
+
+    def test_dirty_on_dict_changes(self):
+        settings = Settings('test')
+        settings['a'] = 1
+        self.assertTrue(settings.dirty)
+        settings.write()
+
+        self.assertIsNone(settings.pop('missing', None))
+        self.assertEqual(1, settings.setdefault('a', 2))
+        self.assertFalse(settings.dirty)
+        self.assertEqual(1, settings.pop('a'))
+        self.assertTrue(settings.dirty)
+        settings.write()
+
+        settings = Settings('test')
+        self.assertFalse(settings.dirty)
+        self.assertNotIn('a', settings)
+
+    def test_migrate_hex_keys(self):
+        with open(os.path.join(self.conf_dir, 'test.json'), 'w') as f:
+            json.dump({'keys': {'device1': '00ff'}}, f)
+
+        settings = Settings('test')
+        self.assertEqual(b'\0\xff', settings.get_key('device1'))
+        self.assertIn('keys', settings)
+        settings.write()
+
+        settings = Settings('test')
+        self.assertNotIn('keys', settings)
+        self.assertEqual(b'\0\xff', settings.get_key('device1'))
+
+    def test_parse_keys_malformed(self):
+        self.assertEqual({}, _parse_keys(b'garbage'))
+        self.assertEqual({}, _parse_keys(b'\0\x01a'))
+        self.assertEqual({}, _parse_keys(b'dev\0'))
+        self.assertEqual({}, _parse_keys(b'dev\0\x10abc'))
+        self.assertEqual({}, _parse_keys(b'd\xffv\0\x01a'))
+        self.assertEqual(
+            {'dev': b'abc'}, _parse_keys(b'dev\0\x03abcother\0\x10abc'))
+
+    def test_malformed_keys_file(self):
+        settings = Settings('test')
+        with open(settings.keys_fname, 'wb') as f:
+            f.write(b'dev1\0\x03abcdev2\0\x10abc')
+
+        settings = Settings('test')
+        self.assertEqual(b'abc', settings.get_key('dev1'))
+        self.assertIsNone(settings.get_key('dev2'))
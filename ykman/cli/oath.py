@@ -27,12 +27,13 @@
 
 from __future__ import absolute_import
 import click
+import hashlib
+import hmac
 import logging
-from threading import Timer
 from binascii import b2a_hex, a2b_hex
 from .util import (
     click_force_option, click_postpone_execution, click_callback,
-    click_parse_b32_key, prompt_for_touch, EnumChoice
+    click_parse_b32_key, prompt_for_touch, prompt_timeout, EnumChoice
 )
 from ..driver_ccid import (
     APDUError,  SW
@@ -62,15 +63,23 @@ def _clear_callback(ctx, param, clear):
         settings = ctx.obj['settings']
 
         controller.clear_password()
-        keys = settings.setdefault('keys', {})
-        if controller.id in keys:
-            del keys[controller.id]
-            settings.write()
+        settings.delete_key(controller.id)
+        _forget_derived(controller.id, settings)
 
         click.echo('Password cleared.')
         ctx.exit()
 
 
+def _prompt_parser(parse):
+    # click.prompt asks again when value_proc raises a UsageError.
+    def inner(val):
+        try:
+            return parse(val)
+        except Exception as e:
+            raise click.UsageError(str(e))
+    return inner
+
+
 @click_callback()
 def click_parse_uri(ctx, param, val):
     try:
@@ -84,7 +93,11 @@ def click_parse_uri(ctx, param, val):
 @click_postpone_execution
 @click.option('-p', '--password', help='Provide a password to unlock the '
               'YubiKey.')
-def oath(ctx, password):
+@click.option('--cache-derived', is_flag=True, help='Skip the slow password '
+              'key derivation on later use by storing, on this machine, the '
+              'key that unlocks the YubiKey together with a fast (SHA-256) '
+              'hash of the password.')
+def oath(ctx, password, cache_derived):
     """
     Manage OATH Application.
 
@@ -105,14 +118,17 @@ def oath(ctx, password):
     try:
         controller = OathController(ctx.obj['dev'].driver)
         ctx.obj['controller'] = controller
-        ctx.obj['settings'] = Settings('oath')
+        settings = Settings('oath')
+        ctx.obj['settings'] = settings
+        ctx.call_on_close(lambda: _flush_settings(settings))
+        ctx.obj['cache_derived'] = cache_derived
     except APDUError as e:
         if e.sw == SW.NOT_FOUND:
             ctx.fail("The OATH application can't be found on this YubiKey.")
         raise
 
     if password:
-        ctx.obj['key'] = controller.derive_key(password)
+        ctx.obj['password'] = password
 
 
 @oath.command()
@@ -128,8 +144,8 @@ def info(ctx):
     click.echo('Password protection ' +
                ('enabled' if controller.locked else 'disabled'))
 
-    keys = ctx.obj['settings'].get('keys', {})
-    if controller.locked and controller.id in keys:
+    settings = ctx.obj['settings']
+    if controller.locked and settings.get_key(controller.id) is not None:
         click.echo('The password for this YubiKey is remembered by ykman.')
 
     if ctx.obj['dev'].is_fips:
@@ -156,10 +172,8 @@ def reset(ctx):
     controller.reset()
 
     settings = ctx.obj['settings']
-    keys = settings.setdefault('keys', {})
-    if old_id in keys:
-        del keys[old_id]
-        settings.write()
+    settings.delete_key(old_id)
+    _forget_derived(old_id, settings)
 
     click.echo(
         'Success! All OATH credentials have been cleared from your YubiKey.')
@@ -201,13 +215,9 @@ def add(ctx, secret, name, issuer, period, oath_type, digits, touch, algorithm,
     digits = int(digits)
 
     if not secret:
-        while True:
-            secret = click.prompt('Enter a secret key (base32)', err=True)
-            try:
-                secret = parse_b32_key(secret)
-                break
-            except Exception as e:
-                click.echo(e)
+        secret = click.prompt(
+            'Enter a secret key (base32)', err=True,
+            value_proc=_prompt_parser(parse_b32_key))
 
     ensure_validated(ctx)
 
@@ -228,13 +238,9 @@ def uri(ctx, uri, touch, force):
     """
 
     if not uri:
-        while True:
-            uri = click.prompt('Enter an OATH URI', err=True)
-            try:
-                uri = CredentialData.from_uri(uri)
-                break
-            except Exception as e:
-                click.echo(e)
+        uri = click.prompt(
+            'Enter an OATH URI', err=True,
+            value_proc=_prompt_parser(CredentialData.from_uri))
 
     ensure_validated(ctx)
     data = uri
@@ -268,20 +274,24 @@ def _add_cred(ctx, data, force):
             controller.version < (4, 3, 1) or ctx.obj['dev'].is_fips):
         ctx.fail('Algorithm SHA512 not supported on this YubiKey.')
 
-    creds = controller.list()
+    firmware_overwrite_issue = (4, 0, 0) < controller.version < (4, 3, 5)
+
+    # Listing is only needed to check for existing credentials.
+    if force and not firmware_overwrite_issue:
+        keys = set()
+    else:
+        keys = set(cred.key for cred in controller.list())
+
     key = data.make_key()
-    if not force and any(cred.key == key for cred in creds):
+    if not force and key in keys:
         click.confirm(
             'A credential called {} already exists on this YubiKey.'
             ' Do you want to overwrite it?'.format(data.name), abort=True,
             err=True)
 
-    firmware_overwrite_issue = (4, 0, 0) < controller.version < (4, 3, 5)
-    cred_is_subset = any(
-        (cred.key.startswith(key) and cred.key != key) for cred in creds)
-
     #  YK4 has an issue with credential overwrite in firmware versions < 4.3.5
-    if firmware_overwrite_issue and cred_is_subset:
+    if firmware_overwrite_issue and any(
+            (k.startswith(key) and k != key) for k in keys):
         ctx.fail(
             'Choose a name that is not a subset of an existing credential.')
 
@@ -315,7 +325,7 @@ def list(ctx, show_hidden, oath_type, period):
              for cred in controller.list()
              if show_hidden or not cred.is_hidden
              ]
-    creds.sort()
+    creds.sort(key=lambda cred: cred.sort_key)
     for cred in creds:
         click.echo(cred.printable_key, nl=False)
         if oath_type:
@@ -343,27 +353,37 @@ def code(ctx, show_hidden, query, single):
     ensure_validated(ctx)
 
     controller = ctx.obj['controller']
-    creds = [(cr, c)
-             for (cr, c) in controller.calculate_all()
-             if show_hidden or not cr.is_hidden
-             ]
 
-    creds = _search(creds, query)
+    # 4.2.0-4.2.6 firmwares need to know about touch before calculating,
+    # which listing doesn't tell us.
+    if query and not (4, 2, 0) <= controller.version <= (4, 2, 6):
+        # Match on the names first, to only calculate the codes needed.
+        hits = _search(controller.list(), query, show_hidden)
+        if len(hits) > 1 and not single:
+            # Reuse the matches instead of searching again.
+            hit_keys = set(cred.key for cred in hits)
+            creds = [(cr, c) for (cr, c) in controller.calculate_all()
+                     if cr.key in hit_keys]
+        else:
+            creds = [(cred, None) for cred in hits]
+    else:
+        creds = _search(controller.calculate_all(), query, show_hidden)
 
     if len(creds) == 1:
         cred, code = creds[0]
-        if cred.touch:
-            prompt_for_touch()
         try:
             if cred.oath_type == OATH_TYPE.HOTP:
                 # HOTP might require touch, we don't know.
-                # Assume yes after 500ms.
-                hotp_touch_timer = Timer(0.500, prompt_for_touch)
-                hotp_touch_timer.start()
-                creds = [(cred, controller.calculate(cred))]
-                hotp_touch_timer.cancel()
+                with prompt_timeout():
+                    code = controller.calculate(cred)
+            elif cred.touch:
+                prompt_for_touch()
+                code = controller.calculate(cred)
             elif code is None:
-                creds = [(cred, controller.calculate(cred))]
+                # Not calculated yet, so touch is unknown.
+                with prompt_timeout():
+                    code = controller.calculate(cred)
+            creds = [(cred, code)]
         except APDUError as e:
             if e.sw == SW.SECURITY_CONDITION_NOT_SATISFIED:
                 ctx.fail('Touch credential timed out!')
@@ -377,24 +397,25 @@ def code(ctx, show_hidden, query, single):
     if single and creds:
         click.echo(creds[0][1].value)
     else:
-        creds.sort()
+        creds.sort(key=lambda entry: entry[0].sort_key)
 
-        outputs = [
-            (
-                cr.printable_key,
+        outputs = []
+        longest_name = longest_code = 0
+        for cr, c in creds:
+            name = cr.printable_key
+            result = (
                 c.value if c
                 else '[Touch Credential]' if cr.touch
                 else '[HOTP Credential]' if cr.oath_type == OATH_TYPE.HOTP
                 else ''
-            ) for (cr, c) in creds
-        ]
-
-        longest_name = max(len(n) for (n, c) in outputs) if outputs else 0
-        longest_code = max(len(c) for (n, c) in outputs) if outputs else 0
-        format_str = u'{:<%d}  {:>%d}' % (longest_name, longest_code)
+            )
+            longest_name = max(longest_name, len(name))
+            longest_code = max(longest_code, len(result))
+            outputs.append((name, result))
 
         for name, result in outputs:
-            click.echo(format_str.format(name, result))
+            click.echo(u'{0:<{1}}  {2:>{3}}'.format(
+                name, longest_name, result, longest_code))
 
 
 @oath.command()
@@ -413,7 +434,7 @@ def delete(ctx, query, force):
     ensure_validated(ctx)
     controller = ctx.obj['controller']
     creds = controller.list()
-    hits = _search(creds, query)
+    hits = _search(creds, query, show_hidden=True)
     if len(hits) == 0:
         click.echo('No matches, nothing to be done.')
     elif len(hits) == 1:
@@ -458,16 +479,17 @@ def set_password(ctx, new_password, remember):
 
     controller = ctx.obj['controller']
     settings = ctx.obj['settings']
-    keys = settings.setdefault('keys', {})
     key = controller.set_password(new_password)
     click.echo('Password updated.')
+    if ctx.obj['cache_derived']:
+        _store_derived(controller.id, new_password, key, settings)
+    else:
+        _forget_derived(controller.id, settings)
     if remember:
-        keys[controller.id] = b2a_hex(key).decode()
-        settings.write()
+        settings.set_key(controller.id, key)
         click.echo('Password remembered')
-    elif controller.id in keys:
-        del keys[controller.id]
-        settings.write()
+    else:
+        settings.delete_key(controller.id)
 
 
 @oath.command('remember-password')
@@ -484,15 +506,13 @@ def remember_password(ctx, forget, clear_all):
     """
     controller = ctx.obj['controller']
     settings = ctx.obj['settings']
-    keys = settings.setdefault('keys', {})
     if clear_all:
-        del settings['keys']
-        settings.write()
+        settings.clear_keys()
+        settings.pop('derived', None)
         click.echo('All passwords have been cleared.')
     elif forget:
-        if controller.id in keys:
-            del keys[controller.id]
-            settings.write()
+        settings.delete_key(controller.id)
+        _forget_derived(controller.id, settings)
         click.echo('Password forgotten.')
     else:
         ensure_validated(ctx, remember=True)
@@ -503,47 +523,109 @@ def ensure_validated(ctx, prompt='Enter your password', remember=False):
     if controller.locked:
 
         # If password given as arg, use it
-        if 'key' in ctx.obj:
-            _validate(ctx, ctx.obj['key'], remember)
+        if 'password' in ctx.obj:
+            password = ctx.obj['password']
+            _validate(ctx, _derive_key(ctx, password), remember, password)
             return
 
         # Use stored key if available
-        keys = ctx.obj['settings'].setdefault('keys', {})
-        if controller.id in keys:
+        settings = ctx.obj['settings']
+        key = settings.get_key(controller.id)
+        if key is not None:
             try:
-                controller.validate(a2b_hex(keys[controller.id]))
+                controller.validate(key)
                 return
             except Exception as e:
                 logger.debug('Error', exc_info=e)
-                del keys[controller.id]
+                settings.delete_key(controller.id)
 
         # Prompt for password
         password = click.prompt(prompt, hide_input=True, err=True)
-        key = controller.derive_key(password)
-        _validate(ctx, key, remember)
+        key = _derive_key(ctx, password)
+        _validate(ctx, key, remember, password)
 
 
-def _validate(ctx, key, remember):
+def _flush_settings(settings):
+    # Settings are written once, when the command finishes.
+    if settings.dirty:
+        settings.write()
+
+
+def _derive_key(ctx, password):
+    controller = ctx.obj['controller']
+    if ctx.obj['cache_derived']:
+        return _cached_derive_key(controller, password, ctx.obj['settings'])
+    return controller.derive_key(password)
+
+
+def _hash_password(device_id, password):
+    data = u'{}:{}'.format(device_id, password).encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+def _cached_derive_key(controller, password, settings):
+    # The device ID is derived from the salt, so a matching entry implies
+    # a matching salt.
+    entry = settings.get('derived', {}).get(controller.id)
+    if entry and hmac.compare_digest(
+            entry['pwhash'].encode('ascii'),
+            _hash_password(controller.id, password).encode('ascii')):
+        return a2b_hex(entry['key'])
+    return controller.derive_key(password)
+
+
+def _store_derived(device_id, password, key, settings):
+    # Unlike remembered keys, which are used without asking for a password,
+    # a derived key is only used when its password is given again. It is
+    # kept in the JSON settings next to that password hash, rather than
+    # through the Settings key API.
+    key_hex = b2a_hex(key).decode()
+    entry = settings.get('derived', {}).get(device_id)
+    if entry and hmac.compare_digest(
+            entry['key'].encode('ascii'), key_hex.encode('ascii')):
+        return
+    derived = dict(settings.get('derived', {}))
+    derived[device_id] = {
+        'pwhash': _hash_password(device_id, password),
+        'key': key_hex,
+    }
+    settings['derived'] = derived
+
+
+def _forget_derived(device_id, settings):
+    derived = settings.get('derived', {})
+    if device_id in derived:
+        settings['derived'] = dict(
+            (k, v) for k, v in derived.items() if k != device_id)
+
+
+def _validate(ctx, key, remember, password):
     try:
         controller = ctx.obj['controller']
         controller.validate(key)
+        # Only cache keys for passwords known to be correct.
+        if ctx.obj['cache_derived']:
+            _store_derived(controller.id, password, key, ctx.obj['settings'])
         if remember:
             settings = ctx.obj['settings']
-            keys = settings.setdefault('keys', {})
-            keys[controller.id] = b2a_hex(key).decode()
-            settings.write()
+            settings.set_key(controller.id, key)
             click.echo('Password remembered.')
     except Exception:
         ctx.fail('Authentication to the YubiKey failed. Wrong password?')
 
 
-def _search(creds, query):
+def _search(creds, query, show_hidden):
+    query_lower = query.lower()
     hits = []
     for entry in creds:
         c = entry[0] if isinstance(entry, tuple) else entry
-        if c.printable_key == query:
+        key = c.printable_key
+        # An exact match is returned even if hidden, as it was asked for.
+        if key == query:
             return [entry]
-        if query.lower() in c.printable_key.lower():
+        if not show_hidden and c.is_hidden:
+            continue
+        if query_lower in key.lower():
             hits.append(entry)
     return hits
 
@@ -30,6 +30,8 @@ from __future__ import absolute_import
 import functools
 import click
 import sys
+from contextlib import contextmanager
+from threading import Timer
 from ..util import parse_b32_key
 from collections import OrderedDict, MutableMapping
 from cryptography.hazmat.primitives import serialization
@@ -163,3 +165,14 @@ def prompt_for_touch():
         click.echo('Touch your YubiKey...', err=True)
     except Exception:
         sys.stderr.write('Touch your YubiKey...\n')
+
+
+@contextmanager
+def prompt_timeout(timeout=0.5):
+    """Prompts for touch if the block takes longer than timeout seconds."""
+    timer = Timer(timeout, prompt_for_touch)
+    try:
+        timer.start()
+        yield None
+    finally:
+        timer.cancel()
@@ -36,7 +36,7 @@ from base64 import b64encode
 from functools import total_ordering
 from enum import IntEnum, unique
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-from cryptography.hazmat.primitives import hmac, hashes
+from cryptography.hazmat.primitives import constant_time, hmac, hashes
 from cryptography.hazmat.backends import default_backend
 from six.moves.urllib.parse import unquote, urlparse, parse_qs
 from .driver_ccid import APDUError, SW
@@ -158,11 +158,14 @@ class Credential(object):
         self.touch = touch
         self.issuer, self.name, period = Credential.parse_key(key)
         self.period = period if oath_type == OATH_TYPE.TOTP else None
+        self._printable_key = None
 
     def __lt__(self, other):
-        a = ((self.issuer or self.name).lower(), self.name.lower())
-        b = ((other.issuer or other.name).lower(), other.name.lower())
-        return a < b
+        return self.sort_key < other.sort_key
+
+    @property
+    def sort_key(self):
+        return ((self.issuer or self.name).lower(), self.name.lower())
 
     @property
     def is_steam(self):
@@ -174,7 +177,9 @@ class Credential(object):
 
     @property
     def printable_key(self):
-        return self.key.decode('utf-8')
+        if self._printable_key is None:
+            self._printable_key = self.key.decode('utf-8')
+        return self._printable_key
 
     @staticmethod
     def parse_key(data):
@@ -395,7 +400,7 @@ class OathController(object):
         verification = h.finalize()
         data = Tlv(TAG.RESPONSE, response) + Tlv(TAG.CHALLENGE, challenge)
         resp = self.send_apdu(INS.VALIDATE, 0, 0, data)
-        if Tlv(resp).value != verification:
+        if not constant_time.bytes_eq(Tlv(resp).value, verification):
             raise ValueError(
                 'Response from validation does not match verification!')
         self._challenge = None
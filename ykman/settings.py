@@ -29,8 +29,13 @@ from __future__ import absolute_import
 
 import os
 import json
+import logging
+import six
+from binascii import a2b_hex
 
 
+logger = logging.getLogger(__name__)
+
 DIR_NAME = '.ykman'
 
 
@@ -40,12 +45,73 @@ def _get_conf_dir():
     return os.path.join(os.path.expanduser('~'), DIR_NAME)
 
 
+def _parse_keys(data):
+    # Records are: device ID, a NUL byte, key length (1 byte), key.
+    # Parsing stops at the first incomplete or malformed record.
+    keys = {}
+    while data:
+        sep = data.find(b'\0')
+        if sep < 1 or sep + 2 > len(data):
+            break
+        start = sep + 2
+        end = start + six.indexbytes(data, sep + 1)
+        if end > len(data):
+            break
+        try:
+            device_id = data[:sep].decode('ascii')
+        except UnicodeDecodeError:
+            break
+        keys[device_id] = data[start:end]
+        data = data[end:]
+    if data:
+        logger.warning('Ignoring malformed data in stored keys')
+    return keys
+
+
+def _serialize_keys(keys):
+    return b''.join(
+        device_id.encode('ascii') + b'\0' + six.int2byte(len(key)) + key
+        for device_id, key in sorted(keys.items()))
+
+
 class Settings(dict):
     def __init__(self, name):
         self.fname = os.path.join(_get_conf_dir(), name + '.json')
+        self.keys_fname = os.path.join(_get_conf_dir(), name + '.keys')
+        self._keys = None
         if os.path.isfile(self.fname):
             with open(self.fname, 'r') as f:
                 self.update(json.load(f))
+        self.dirty = False
+
+    # Changes to top level entries mark the settings as needing a write.
+    # Nested values must be reassigned for their changes to be noticed.
+
+    def __setitem__(self, key, value):
+        super(Settings, self).__setitem__(key, value)
+        self.dirty = True
+
+    def __delitem__(self, key):
+        super(Settings, self).__delitem__(key)
+        self.dirty = True
+
+    def pop(self, key, *args):
+        if key in self:
+            self.dirty = True
+        return super(Settings, self).pop(key, *args)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self.dirty = True
+        return super(Settings, self).setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        super(Settings, self).update(*args, **kwargs)
+        self.dirty = True
+
+    def clear(self):
+        super(Settings, self).clear()
+        self.dirty = True
 
     def __eq__(self, other):
         return other is not None and self.fname == other.fname
@@ -53,12 +119,54 @@ class Settings(dict):
     def __ne__(self, other):
         return other is not None or self.fname != other.fname
 
+    def _load_keys(self):
+        if self._keys is None:
+            self._keys = {}
+            if os.path.isfile(self.keys_fname):
+                with open(self.keys_fname, 'rb') as f:
+                    self._keys = _parse_keys(f.read())
+            # Older versions stored keys hex encoded in the JSON file.
+            # They are dropped from it when the keys are next written.
+            for device_id, key in self.get('keys', {}).items():
+                self._keys.setdefault(device_id, a2b_hex(key))
+        return self._keys
+
+    def get_key(self, device_id):
+        return self._load_keys().get(device_id)
+
+    def set_key(self, device_id, key):
+        self._load_keys()[device_id] = key
+        self.dirty = True
+
+    def delete_key(self, device_id):
+        """Deletes a stored key, returning True if there was one."""
+        if self._load_keys().pop(device_id, None) is None:
+            return False
+        self.dirty = True
+        return True
+
+    def clear_keys(self):
+        self._keys = {}
+        self.pop('keys', None)
+        self.dirty = True
+
     def write(self):
         conf_dir = os.path.dirname(self.fname)
         if not os.path.isdir(conf_dir):
             os.makedirs(conf_dir)
-        data = json.dumps(self, indent=2)
+        if self._keys is None:
+            data = json.dumps(self, indent=2)
+        else:
+            data = json.dumps(
+                dict((k, v) for k, v in self.items() if k != 'keys'), indent=2)
         with open(self.fname, 'w') as f:
             f.write(data)
+        if self._keys is not None:
+            if self._keys:
+                with open(self.keys_fname, 'wb') as f:
+                    f.write(_serialize_keys(self._keys))
+            elif os.path.isfile(self.keys_fname):
+                os.remove(self.keys_fname)
+        self.dirty = False
 
     __hash__ = None